@@ -26,6 +26,16 @@ export async function POST(request: Request) {
       }),
     });
 
+    if (serviceRes.status === 429) {
+      // Admission queue is full — pass the back-off hint through to the client
+      const retryAfter = serviceRes.headers.get("Retry-After") ?? "30";
+      console.warn(`[rlm-stream] service at capacity, retry after ${retryAfter}s`);
+      return NextResponse.json(
+        { error: "RLM service is busy, please retry shortly" },
+        { status: 429, headers: { "Retry-After": retryAfter } }
+      );
+    }
+
     if (!serviceRes.ok || !serviceRes.body) {
       const err = await serviceRes.text().catch(() => "unknown error");
       console.error("[rlm-stream] service error:", err);
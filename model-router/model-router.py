@@ -1,20 +1,24 @@
 import os
+import fcntl
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import List, Optional
 from pydantic import BaseModel
 import numpy as np
-import torch
-from torch import nn
-from torch.nn import functional as F
 from fastapi import FastAPI, HTTPException
 from openai import OpenAI
 from dotenv import load_dotenv
-from safetensors.torch import load_file
-
-import torch
-from huggingface_hub import PyTorchModelHubMixin
 
 load_dotenv()
-OPENAI_CLIENT = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# "torch" (default) or "numpy" — the numpy backend never imports torch
+ROUTER_BACKEND = os.getenv("ROUTER_BACKEND", "torch")
 
 app = FastAPI()
 
@@ -84,69 +88,335 @@ MODEL_IDS = {
     "zephyr-7b-alpha": 62,
     "zephyr-7b-beta": 63,
 }
+MODEL_NAMES = {model_id: name for name, model_id in MODEL_IDS.items()}
 
+# Max inputs per OpenAI embeddings request
+EMBEDDING_BATCH_LIMIT = 2048
 
-class MFModel(torch.nn.Module, PyTorchModelHubMixin):
-    def __init__(
-        self,
-        dim,
-        num_models,
-        text_dim,
-        num_classes,
-        use_proj,
-    ):
-        super().__init__()
-        self._name = "TextMF"
-        self.use_proj = use_proj
-        self.P = torch.nn.Embedding(num_models, dim)
 
-        self.embedding_model = "text-embedding-3-small"
+# Embedding providers: name (part of the cache key), dim, embed(prompts) -> (n, dim) float32
 
-        if self.use_proj:
-            self.text_proj = torch.nn.Sequential(
-                torch.nn.Linear(text_dim, dim, bias=False)
+class OpenAIEmbeddingProvider:
+    def __init__(self, model="text-embedding-3-small", dim=1536):
+        self.name = model
+        self.dim = dim
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    def embed(self, prompts):
+        rows = []
+        for start in range(0, len(prompts), EMBEDDING_BATCH_LIMIT):
+            resp = self.client.embeddings.create(
+                input=prompts[start:start + EMBEDDING_BATCH_LIMIT], model=self.name
             )
-        else:
-            assert (
-                text_dim == dim
-            ), f"text_dim {text_dim} must be equal to dim {dim} if not using projection"
+            rows.extend(d.embedding for d in sorted(resp.data, key=lambda d: d.index))
+        return np.asarray(rows, dtype=np.float32).reshape(len(prompts), self.dim)
+
+
+class LocalEmbeddingProvider:
+    """
+    Offline stand-in: signed feature hashing of character trigrams, L2-normalised.
+    Deterministic and network-free, for development and benchmarks; routing
+    quality is not comparable to the OpenAI embeddings the weights were trained on.
+    """
+
+    def __init__(self, dim=1536):
+        self.name = f"local-trigram-{dim}"
+        self.dim = dim
+
+    def embed(self, prompts):
+        out = np.zeros((len(prompts), self.dim), dtype=np.float32)
+        for row, prompt in enumerate(prompts):
+            text = f"  {prompt.lower()}  "
+            for i in range(len(text) - 2):
+                h = int.from_bytes(hashlib.blake2b(text[i:i + 3].encode(), digest_size=8).digest(), "little")
+                out[row, h % self.dim] += 1.0 if (h >> 63) else -1.0
+            norm = np.linalg.norm(out[row])
+            if norm:
+                out[row] /= norm
+        return out
+
+
+class DiskEmbeddingStore:
+    """
+    Append-only persistent tier: float16 rows in `<path>.f16` (read through a
+    memory map) and one "key row" line per vector in `<path>.idx`. The index is
+    written after the data, so a crash can only leave unreferenced rows; a torn
+    trailing row is cut off before the next append. Appends hold an flock on
+    `<path>.lock` so several processes can share one directory.
+    """
+
+    def __init__(self, path, dim):
+        self.dim = dim
+        self.row_bytes = 2 * dim
+        self.data_path = path + ".f16"
+        self.index_path = path + ".idx"
+        self.lock_path = path + ".lock"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._mmap = None
+        self._lock = threading.Lock()
+        with self._file_lock():
+            data_rows = self._whole_rows()
+        self.rows = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    parts = line.split()
+                    # Skip a torn last line and rows whose data never made it to disk
+                    if len(parts) == 2 and parts[1].isdigit() and int(parts[1]) < data_rows:
+                        self.rows[parts[0]] = int(parts[1])
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _whole_rows(self):
+        """Row count of the data file, truncating a partially written last row."""
+        if not os.path.exists(self.data_path):
+            return 0
+        size = os.path.getsize(self.data_path)
+        if size % self.row_bytes:
+            os.truncate(self.data_path, size - size % self.row_bytes)
+        return size // self.row_bytes
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        with self._lock:
+            if self._mmap is None or row >= self._mmap.shape[0]:
+                n = os.path.getsize(self.data_path) // self.row_bytes
+                self._mmap = np.memmap(self.data_path, dtype=np.float16, mode="r", shape=(n, self.dim))
+            return np.asarray(self._mmap[row], dtype=np.float32)
+
+    def put_many(self, keys, vectors):
+        with self._lock, self._file_lock():
+            start = self._whole_rows()
+            with open(self.data_path, "ab") as f:
+                f.write(np.asarray(vectors, dtype=np.float16).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.index_path, "ab+") as f:
+                lines = "".join(f"{k} {start + i}\n" for i, k in enumerate(keys)).encode()
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        lines = b"\n" + lines  # start after a torn last line
+                f.write(lines)
+            for i, key in enumerate(keys):
+                self.rows[key] = start + i
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by (provider name, prompt hash): an in-memory LRU in front
+    of an optional DiskEmbeddingStore in front of the provider.
+    """
+
+    def __init__(self, provider, memory_size=10_000, disk_dir=None):
+        self.provider = provider
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.disk = DiskEmbeddingStore(os.path.join(disk_dir, provider.name), provider.dim) if disk_dir else None
+        self.counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def key(self, prompt):
+        return hashlib.sha256(f"{self.provider.name}\0{prompt}".encode()).hexdigest()
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self.memory[key] = vector
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    def get_many(self, prompts):
+        """(len(prompts), dim) float32 embeddings; only uncached prompts hit the provider."""
+        keys = [self.key(p) for p in prompts]
+        out = np.empty((len(prompts), self.provider.dim), dtype=np.float32)
+        missing = OrderedDict()  # key -> (prompt, [rows])
+        for row, (prompt, key) in enumerate(zip(prompts, keys)):
+            with self._lock:
+                vector = self.memory.get(key)
+                if vector is not None:
+                    self.memory.move_to_end(key)
+            if vector is not None:
+                self.counts["memory_hits"] += 1
+            elif self.disk is not None and (vector := self.disk.get(key)) is not None:
+                self.counts["disk_hits"] += 1
+                self._remember(key, vector)
+            else:
+                self.counts["misses"] += 1
+                missing.setdefault(key, (prompt, []))[1].append(row)
+                continue
+            out[row] = vector
+        if missing:
+            vectors = self.provider.embed([prompt for prompt, _ in missing.values()])
+            for (key, (_, rows)), vector in zip(missing.items(), vectors):
+                out[rows] = vector
+                self._remember(key, vector)
+            if self.disk is not None:
+                self.disk.put_many(list(missing), vectors)
+        return out
+
+    def stats(self):
+        lookups = sum(self.counts.values())
+        hits = self.counts["memory_hits"] + self.counts["disk_hits"]
+        return {
+            **self.counts,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_entries": len(self.disk.rows) if self.disk is not None else 0,
+            "provider": self.provider.name,
+        }
 
-        self.classifier = torch.nn.Sequential(
-            torch.nn.Linear(dim, num_classes, bias=False)
-        )
 
-    def get_device(self):
-        return self.P.weight.device
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
 
-    def forward(self, model_id, prompt):
-        model_id = torch.tensor(model_id, dtype=torch.long).to(self.get_device())
 
-        model_embed = self.P(model_id)
-        model_embed = torch.nn.functional.normalize(model_embed, p=2, dim=1)
+def rank_logits(logits, baseline):
+    """(model_id, win rate vs baseline) for every model, best first."""
+    win_rates = sigmoid(logits - logits[baseline])
+    order = np.argsort(-win_rates, kind="stable")
+    return [(int(i), float(win_rates[i])) for i in order]
 
-        prompt_embed = (
-            OPENAI_CLIENT.embeddings.create(input=[prompt], model=self.embedding_model)
-            .data[0]
-            .embedding
+
+SAFETENSORS_DTYPES = {"F16": np.float16, "F32": np.float32, "F64": np.float64}
+
+
+def load_safetensors_mmap(path):
+    """Memory-map every tensor of a .safetensors file as a read-only numpy array."""
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        begin, _ = info["data_offsets"]
+        tensors[name] = np.memmap(
+            path, dtype=SAFETENSORS_DTYPES[info["dtype"]], mode="r",
+            offset=8 + header_len + begin, shape=tuple(info["shape"]),
         )
-        prompt_embed = torch.tensor(prompt_embed, device=self.get_device())
-        prompt_embed = self.text_proj(prompt_embed)
+    return tensors
 
-        return self.classifier(model_embed * prompt_embed).squeeze()
 
-    @torch.no_grad()
-    def pred_win_rate(self, model_a, model_b, prompt):
-        logits = self.forward([model_a, model_b], prompt)
-        winrate = torch.sigmoid(logits[0] - logits[1]).item()
-        print(winrate)
-        return winrate
+class NumpyMFModel:
+    """
+    Inference-only MFModel on numpy: same weights file, same numerics, no torch.
+    Parameters use torch's default initialisation until load() is called.
+    """
+
+    def __init__(self, dim, num_models, text_dim, num_classes, use_proj):
+        rng = np.random.default_rng()
+        self.use_proj = use_proj
+        self.embedding_model = "text-embedding-3-small"
+        self.P = rng.standard_normal((num_models, dim), dtype=np.float32)
+        bound = 1 / np.sqrt(text_dim)
+        self.text_proj = rng.uniform(-bound, bound, (dim, text_dim)).astype(np.float32) if use_proj else None
+        bound = 1 / np.sqrt(dim)
+        self.classifier = rng.uniform(-bound, bound, (num_classes, dim)).astype(np.float32)
 
     def load(self, path):
-        self.load_state_dict(load_file(path))
+        weights = load_safetensors_mmap(path)
+        self.P = weights["P.weight"]
+        self.classifier = weights["classifier.0.weight"]
+        if self.use_proj:
+            self.text_proj = weights["text_proj.0.weight"]
+
+    def precompute_scores(self):
+        """See MFModel.precompute_scores; F.normalize clamps the norm at 1e-12."""
+        norms = np.maximum(np.linalg.norm(self.P, axis=1, keepdims=True), 1e-12)
+        scaled = (self.P / norms) * self.classifier[0]
+        if self.use_proj:
+            scaled = scaled @ self.text_proj
+        self.score_matrix = np.ascontiguousarray(scaled, dtype=np.float32)
+
+    def embed_batch(self, prompts):
+        return EMBEDDINGS.get_many(prompts)
+
+
+if ROUTER_BACKEND == "torch":
+    import torch
+    from torch.nn import functional as F
+    from safetensors.torch import load_file
+    from huggingface_hub import PyTorchModelHubMixin
+
+    class MFModel(torch.nn.Module, PyTorchModelHubMixin):
+        def __init__(
+            self,
+            dim,
+            num_models,
+            text_dim,
+            num_classes,
+            use_proj,
+        ):
+            super().__init__()
+            self._name = "TextMF"
+            self.use_proj = use_proj
+            self.P = torch.nn.Embedding(num_models, dim)
+
+            self.embedding_model = "text-embedding-3-small"
+
+            if self.use_proj:
+                self.text_proj = torch.nn.Sequential(
+                    torch.nn.Linear(text_dim, dim, bias=False)
+                )
+            else:
+                assert (
+                    text_dim == dim
+                ), f"text_dim {text_dim} must be equal to dim {dim} if not using projection"
+
+            self.classifier = torch.nn.Sequential(
+                torch.nn.Linear(dim, num_classes, bias=False)
+            )
+
+        def get_device(self):
+            return self.P.weight.device
+
+        @torch.no_grad()
+        def precompute_scores(self):
+            """
+            The logit is linear in the prompt embedding e:
+                classifier(normalize(P[m]) * text_proj(e)) = ((normalize(P[m]) * w_c) @ W_proj) . e
+            so fold everything but e into one (num_models, text_dim) matrix; a single
+            matrix-vector product then scores every model for a prompt.
+            """
+            model_embed = F.normalize(self.P.weight, p=2, dim=1)
+            scaled = model_embed * self.classifier[0].weight[0]
+            if self.use_proj:
+                scaled = scaled @ self.text_proj[0].weight
+            self.score_matrix = scaled.contiguous()
+
+        def embed_batch(self, prompts):
+            """(len(prompts), text_dim) embeddings via the shared EMBEDDINGS cache."""
+            return torch.from_numpy(EMBEDDINGS.get_many(prompts)).to(self.get_device())
+
+        def embed(self, prompt):
+            return self.embed_batch([prompt])[0]
+
+        def forward(self, model_id, prompt):
+            model_id = torch.tensor(model_id, dtype=torch.long).to(self.get_device())
+
+            model_embed = self.P(model_id)
+            model_embed = torch.nn.functional.normalize(model_embed, p=2, dim=1)
+
+            prompt_embed = self.text_proj(self.embed(prompt))
+
+            return self.classifier(model_embed * prompt_embed).squeeze()
+
+        def load(self, path):
+            self.load_state_dict(load_file(path))
 
 
 # Initialize model with the same dimensions as the saved model
-model = MFModel(
+model = (NumpyMFModel if ROUTER_BACKEND == "numpy" else MFModel)(
     dim=128,           # Changed from 100 to 128 to match saved weights
     num_models=64,     # Changed from 100 to 64 to match saved weights
     text_dim=1536,     # OpenAI embedding dimension
@@ -164,6 +434,193 @@ try:
 except Exception as e:
     print(f"Error loading model weights: {e}")
     print("No saved weights found, using initialized weights")
+model.precompute_scores()
+
+# Embedding provider ("openai" or "local" for the offline stand-in) and cache.
+# Set ROUTER_EMBEDDING_CACHE_DIR="" to disable the on-disk tier.
+if os.getenv("ROUTER_EMBEDDING_PROVIDER", "openai") == "local":
+    embedding_provider = LocalEmbeddingProvider()
+else:
+    embedding_provider = OpenAIEmbeddingProvider(model.embedding_model)
+EMBEDDINGS = EmbeddingCache(
+    embedding_provider,
+    memory_size=int(os.getenv("ROUTER_EMBEDDING_CACHE_SIZE", "10000")),
+    disk_dir=os.getenv("ROUTER_EMBEDDING_CACHE_DIR", "embedding_cache") or None,
+)
+
+
+class SemanticDecisionCache:
+    """
+    Reuses the logits of a recently scored prompt whose embedding has cosine
+    similarity >= threshold with the new one. Candidates come from a random-
+    hyperplane LSH index (the query's bucket plus every bucket one bit away);
+    entries are evicted least-recently-used once capacity is reached.
+
+    Lookups happen after the prompt is embedded, so a hit only saves scoring
+    that embedding. With the precomputed score matrix that is one cheap matmul
+    row, less than the lookup costs, and a hit returns another prompt's decision.
+    The cache only pays off when scoring is expensive (e.g. a larger model).
+    """
+
+    def __init__(self, dim, num_models, capacity=4096, threshold=0.95, bits=12, seed=0):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.planes = np.random.default_rng(seed).standard_normal((bits, dim)).astype(np.float32)
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.logits = np.zeros((capacity, num_models), dtype=np.float32)
+        self.slots = OrderedDict()  # slot -> bucket, in LRU order
+        self.buckets = {}  # bucket -> set of slots
+        self.bit_values = 1 << np.arange(bits, dtype=np.int64)
+        self.flips = [0] + [1 << b for b in range(bits)]
+        self.counts = {"lookups": 0, "hits": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+    def _bucket(self, vector):
+        return int(((self.planes @ vector) > 0) @ self.bit_values)
+
+    def lookup(self, vector):
+        """Cached logits for a unit-norm embedding, or None."""
+        bucket = self._bucket(vector)
+        with self._lock:
+            self.counts["lookups"] += 1
+            candidates = [slot for flip in self.flips for slot in self.buckets.get(bucket ^ flip, ())]
+            if not candidates:
+                return None
+            sims = self.vectors[candidates] @ vector
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            slot = candidates[best]
+            self.slots.move_to_end(slot)
+            self.counts["hits"] += 1
+            return self.logits[slot].copy()
+
+    def insert(self, vector, logits):
+        bucket = self._bucket(vector)
+        with self._lock:
+            if len(self.slots) < self.capacity:
+                slot = len(self.slots)
+            else:
+                slot, old_bucket = self.slots.popitem(last=False)
+                self.buckets[old_bucket].discard(slot)
+                self.counts["evictions"] += 1
+            self.vectors[slot] = vector
+            self.logits[slot] = logits
+            self.slots[slot] = bucket
+            self.buckets.setdefault(bucket, set()).add(slot)
+
+    def stats(self):
+        lookups = self.counts["lookups"]
+        return {
+            **self.counts,
+            "hit_rate": self.counts["hits"] / lookups if lookups else 0.0,
+            "entries": len(self.slots),
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+        }
+
+
+# Off by default (see SemanticDecisionCache); set ROUTER_SEMANTIC_CACHE_SIZE > 0 to enable
+SEMANTIC_CACHE_SIZE = int(os.getenv("ROUTER_SEMANTIC_CACHE_SIZE", "0"))
+SCORE_MATRIX = np.asarray(model.score_matrix, dtype=np.float32)
+SEMANTIC_CACHE = SemanticDecisionCache(
+    SCORE_MATRIX.shape[1], SCORE_MATRIX.shape[0],
+    capacity=SEMANTIC_CACHE_SIZE,
+    threshold=float(os.getenv("ROUTER_SEMANTIC_THRESHOLD", "0.95")),
+) if SEMANTIC_CACHE_SIZE > 0 else None
+
+
+def score_prompts(prompts):
+    """(len(prompts), num_models) logits; near-duplicates of recent prompts reuse cached logits."""
+    embeds = np.asarray(model.embed_batch(prompts), dtype=np.float32)
+    if SEMANTIC_CACHE is None:
+        return embeds @ SCORE_MATRIX.T
+    norms = np.maximum(np.linalg.norm(embeds, axis=1, keepdims=True), 1e-12)
+    units = embeds / norms
+    logits = np.empty((len(prompts), SCORE_MATRIX.shape[0]), dtype=np.float32)
+    missing = []
+    for i, unit in enumerate(units):
+        cached = SEMANTIC_CACHE.lookup(unit)
+        if cached is None:
+            missing.append(i)
+        else:
+            logits[i] = cached
+    if missing:
+        logits[missing] = embeds[missing] @ SCORE_MATRIX.T
+        for i in missing:
+            SEMANTIC_CACHE.insert(units[i], logits[i])
+    return logits
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent single-prompt requests: callers awaiting submit() within
+    max_wait_ms of each other (up to max_batch) are embedded and scored together
+    by score_fn(prompts) -> (n, num_models) logits, on a worker thread so the
+    event loop keeps serving other requests.
+    """
+
+    def __init__(self, score_fn, max_batch=64, max_wait_ms=5.0, workers=4):
+        self.score_fn = score_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.timer = None
+        self.counts = {"requests": 0, "batches": 0, "busy_seconds": 0.0}
+
+    async def submit(self, prompt):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((prompt, future))
+        self.counts["requests"] += 1
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        self.counts["batches"] += 1
+        started = time.monotonic()
+        try:
+            logits = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.score_fn, [prompt for prompt, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.counts["busy_seconds"] += time.monotonic() - started
+        for (_, future), row in zip(batch, logits):
+            if not future.done():
+                future.set_result(row)
+
+    def stats(self):
+        batches = self.counts["batches"]
+        return {
+            **self.counts,
+            "avg_batch_size": self.counts["requests"] / batches if batches else 0.0,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+BATCHER = MicroBatcher(
+    score_prompts,
+    max_batch=int(os.getenv("ROUTER_MAX_BATCH", "64")),
+    max_wait_ms=float(os.getenv("ROUTER_MAX_WAIT_MS", "5")),
+)
 
 # FastAPI models
 class PredictionRequest(BaseModel):
@@ -175,29 +632,122 @@ class PredictionResponse(BaseModel):
     prediction: bool
     recommended_model: str
 
+class BatchPredictionRequest(BaseModel):
+    model_win: int
+    model_loss: int
+    prompts: List[str]
+
+class BatchPredictionResponse(BaseModel):
+    predictions: List[PredictionResponse]
+
+def to_prediction(win_rate):
+    prediction = win_rate > 0.1159
+    recommended_model = "gpt-4-1106-preview" if prediction else "mixtral-8x7b-instruct-v0.1"
+    return PredictionResponse(
+        prediction=prediction,
+        recommended_model=recommended_model
+    )
+
+def check_model_ids(*model_ids):
+    """400 for ids outside MODEL_IDS (indexing the logits would wrap negative ones)."""
+    for model_id in model_ids:
+        if not 0 <= model_id < len(MODEL_IDS):
+            raise HTTPException(status_code=400, detail=f"Unknown model id: {model_id}")
+
 @app.post("/predict", response_model=PredictionResponse)
 async def predict(request: PredictionRequest):
+    check_model_ids(request.model_win, request.model_loss)
+    try:
+        logits = await BATCHER.submit(request.prompt)
+        win_rate = float(sigmoid(logits[request.model_win] - logits[request.model_loss]))
+        return to_prediction(win_rate)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/predict_batch", response_model=BatchPredictionResponse)
+async def predict_batch(request: BatchPredictionRequest):
+    check_model_ids(request.model_win, request.model_loss)
+    if not request.prompts:
+        return BatchPredictionResponse(predictions=[])
     try:
-        win_rate = model.pred_win_rate(
-            request.model_win,
-            request.model_loss,
-            request.prompt
+        logits = await asyncio.get_running_loop().run_in_executor(
+            BATCHER.executor, score_prompts, request.prompts
         )
-        
-        prediction = win_rate > 0.1159
-        recommended_model = "gpt-4-1106-preview" if prediction else "mixtral-8x7b-instruct-v0.1"
-        
-        return PredictionResponse(
-            prediction=prediction,
-            recommended_model=recommended_model
+        win_rates = sigmoid(logits[:, request.model_win] - logits[:, request.model_loss]).tolist()
+        return BatchPredictionResponse(predictions=[to_prediction(w) for w in win_rates])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+class RankRequest(BaseModel):
+    prompt: str
+    baseline: str = "gpt-4-1106-preview"
+    top_k: Optional[int] = None
+
+class ModelWinRate(BaseModel):
+    model: str
+    win_rate: float
+
+class RankResponse(BaseModel):
+    baseline: str
+    rankings: List[ModelWinRate]
+
+@app.post("/rank", response_model=RankResponse)
+async def rank(request: RankRequest):
+    if request.baseline not in MODEL_IDS:
+        raise HTTPException(status_code=400, detail=f"Unknown baseline model: {request.baseline}")
+    try:
+        logits = await BATCHER.submit(request.prompt)
+        ranked = rank_logits(logits, MODEL_IDS[request.baseline])
+        if request.top_k is not None:
+            ranked = ranked[:request.top_k]
+        return RankResponse(
+            baseline=request.baseline,
+            rankings=[ModelWinRate(model=MODEL_NAMES[i], win_rate=w) for i, w in ranked]
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/stats")
+async def stats():
+    return {
+        "embedding_cache": EMBEDDINGS.stats(),
+        "batcher": BATCHER.stats(),
+        "semantic_cache": SEMANTIC_CACHE.stats() if SEMANTIC_CACHE is not None else None,
+    }
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+def check_parity(path="model.safetensors", n=256, tol=1e-5):
+    """Compare NumpyMFModel against the loaded torch model on random embeddings."""
+    if ROUTER_BACKEND != "torch":
+        raise SystemExit("run with ROUTER_BACKEND=torch to compare against the torch path")
+    reference = NumpyMFModel(dim=128, num_models=64, text_dim=1536, num_classes=1, use_proj=True)
+    reference.load(path)
+    reference.precompute_scores()
+
+    embeds = np.random.default_rng(0).standard_normal((n, 1536), dtype=np.float32)
+    with torch.no_grad():
+        # Unfolded forward pass (P -> normalize -> text_proj -> classifier) for every model
+        torch_logits = torch.stack([
+            model.classifier(F.normalize(model.P.weight, p=2, dim=1) * model.text_proj(e)).squeeze(-1)
+            for e in torch.from_numpy(embeds)
+        ]).numpy()
+    numpy_logits = embeds @ reference.score_matrix.T
+    logit_diff = float(np.abs(torch_logits - numpy_logits).max())
+    win_diff = float(np.abs(sigmoid(torch_logits[:, 24] - torch_logits[:, 36])
+                            - sigmoid(numpy_logits[:, 24] - numpy_logits[:, 36])).max())
+    print(f"max |logit diff| = {logit_diff:.2e}, max |win-rate diff| = {win_diff:.2e}")
+    if logit_diff > tol * max(1.0, float(np.abs(torch_logits).max())):
+        raise SystemExit("numpy backend does not match torch")
+
+
 if __name__ == "__main__":
+    import sys
+    if "--check-parity" in sys.argv:
+        check_parity()
+        sys.exit(0)
+
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
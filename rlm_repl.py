@@ -12,6 +12,7 @@ import json
 import re
 import io
 import contextlib
+import collections
 import concurrent.futures
 import requests
 
@@ -20,6 +21,7 @@ NEXT_JS_URL = os.environ.get("NEXT_JS_URL", "http://localhost:3000")
 MODEL = os.environ.get("MODEL", "llama3.1-8b")
 PROMPT = os.environ.get("PROMPT", "")
 MAX_ITERATIONS = int(os.environ.get("MAX_ITERATIONS", "10"))
+CONTEXT_MODE = os.environ.get("CONTEXT_MODE", "text")  # "text" | "structured"
 
 # Read context from file to avoid ARG_MAX env var size limits
 _context_file = os.environ.get("CONTEXT_FILE", "")
@@ -34,6 +36,132 @@ else:
 _call_counter = [0]
 
 
+# ─── Structured context (same as rlm_service.py) ─────────────────────────────
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WS = re.compile(r"[ \t\n\r]*")
+
+
+class StructuredContext:
+    """
+    Lazily decoded view over a JSON list/dict context.
+
+    The raw text is scanned once for top-level document boundaries; each document
+    is only json-decoded the first time it is accessed and then cached, so a
+    large array is never materialised in full unless the model walks all of it.
+    Behaves like a list (or, for dicts, a list of values that can also be
+    indexed by key).
+    """
+
+    def __init__(self, raw: str, kind: str, spans: list, keys: list | None = None):
+        self._raw = raw
+        self.kind = kind
+        self._spans = spans
+        self._keys = keys
+        self._index = {k: i for i, k in enumerate(keys)} if keys is not None else None
+        self._cache: dict = {}
+        self.offsets = [s for s, _ in spans]
+        self.lengths = [e - s for s, e in spans]
+
+    @classmethod
+    def parse(cls, raw: str):
+        """
+        Scan `raw` as a JSON array/object; returns None if it isn't one.
+
+        Elements are walked one at a time with the C decoder's raw_decode, keeping
+        only their spans, so peak memory is one document rather than the whole tree.
+        The decoded values are discarded, so a document that is later accessed is
+        decoded a second time by _doc; the scan itself is still a single pass.
+        """
+        pos = _JSON_WS.match(raw).end()
+        if pos >= len(raw) or raw[pos] not in "[{":
+            return None
+        kind = "list" if raw[pos] == "[" else "dict"
+        close = "]" if kind == "list" else "}"
+        spans, keys = [], ([] if kind == "dict" else None)
+        pos = _JSON_WS.match(raw, pos + 1).end()
+        try:
+            if raw[pos] == close:
+                pos += 1
+            else:
+                while True:
+                    if kind == "dict":
+                        key, pos = _JSON_DECODER.raw_decode(raw, pos)
+                        if not isinstance(key, str):
+                            return None
+                        keys.append(key)
+                        pos = _JSON_WS.match(raw, pos).end()
+                        if raw[pos] != ":":
+                            return None
+                        pos = _JSON_WS.match(raw, pos + 1).end()
+                    _, end = _JSON_DECODER.raw_decode(raw, pos)
+                    spans.append((pos, end))
+                    pos = _JSON_WS.match(raw, end).end()
+                    if raw[pos] == close:
+                        pos += 1
+                        break
+                    if raw[pos] != ",":
+                        return None
+                    pos = _JSON_WS.match(raw, pos + 1).end()
+        except (IndexError, ValueError):
+            return None
+        if raw[pos:].strip():
+            return None
+        return cls(raw, kind, spans, keys)
+
+    @property
+    def raw(self) -> str:
+        """The whole context as the original JSON text."""
+        return self._raw
+
+    def text(self, i: int) -> str:
+        """Raw JSON text of document `i` (no decoding)."""
+        start, end = self._spans[i]
+        return self._raw[start:end]
+
+    def keys(self) -> list:
+        return list(self._keys) if self._keys is not None else list(range(len(self)))
+
+    def items(self):
+        return zip(self.keys(), self)
+
+    def _doc(self, i: int):
+        if i not in self._cache:
+            self._cache[i] = _JSON_DECODER.raw_decode(self._raw, self._spans[i][0])[0]
+        return self._cache[i]
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def __iter__(self):
+        return (self._doc(i) for i in range(len(self)))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._doc(i) for i in range(*key.indices(len(self)))]
+        if isinstance(key, str):
+            if self._index is None or key not in self._index:
+                raise KeyError(key)
+            return self._doc(self._index[key])
+        return self._doc(range(len(self))[key])
+
+    def __repr__(self) -> str:
+        return (f"<StructuredContext {self.kind}: {len(self)} documents, "
+                f"{len(self._raw)} chars>")
+
+
+def _ctx_text(ctx) -> str:
+    """Text to send as a sub-call's context: StructuredContext views and other
+    JSON-able values (e.g. `context[:2]` in structured mode) are serialised."""
+    if ctx is None:
+        return ""
+    if isinstance(ctx, str):
+        return ctx
+    if isinstance(ctx, StructuredContext):
+        return ctx.raw
+    return json.dumps(ctx, default=str, ensure_ascii=False)
+
+
 # ─── HTTP helpers ─────────────────────────────────────────────────────────────
 
 def _push_event(event: dict):
@@ -65,7 +193,7 @@ def _sub_llm_call(prompt: str, ctx=None) -> str:
     """Direct LLM answer for llm_query() sub-calls (depth=1)."""
     _call_counter[0] += 1
     node_id = f"node_{_call_counter[0]}"
-    effective_ctx = ctx if ctx is not None else CONTEXT
+    effective_ctx = _ctx_text(ctx) if ctx is not None else CONTEXT
 
     _push_event({
         "type": "node_start",
@@ -98,10 +226,67 @@ def _sub_llm_batched(prompts: list, ctx=None) -> list:
 
 # ─── REPL execution ───────────────────────────────────────────────────────────
 
+# How much of a REPL block's output is kept: the first HEAD and last TAIL chars.
+# Defaults keep stdout + stderr together under the 10K per-block conversation cap.
+REPL_STDOUT_HEAD = int(os.environ.get("RLM_REPL_STDOUT_HEAD", "6000"))
+REPL_STDOUT_TAIL = int(os.environ.get("RLM_REPL_STDOUT_TAIL", "2000"))
+REPL_STDERR_HEAD = int(os.environ.get("RLM_REPL_STDERR_HEAD", "800"))
+REPL_STDERR_TAIL = int(os.environ.get("RLM_REPL_STDERR_TAIL", "800"))
+
+
+class CappedOutput(io.TextIOBase):
+    """
+    Write-only text stream that keeps just the first `head` and last `tail`
+    chars written plus a running total, so capture memory stays constant no
+    matter how much the REPL prints (e.g. `print(context)` on a huge document).
+    """
+
+    def __init__(self, head: int, tail: int):
+        self.head_limit = head
+        self.tail_limit = tail
+        self._head: list[str] = []
+        self._head_len = 0
+        self._tail: collections.deque = collections.deque()
+        self._tail_len = 0
+        self.total = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        n = len(s)
+        self.total += n
+        room = self.head_limit - self._head_len
+        if room > 0:
+            self._head.append(s[:room])
+            self._head_len += min(n, room)
+        rest = n - max(room, 0)
+        if rest <= 0 or self.tail_limit <= 0:
+            return n
+        if rest >= self.tail_limit:
+            self._tail.clear()
+            self._tail.append(s[n - self.tail_limit:])
+            self._tail_len = self.tail_limit
+            return n
+        self._tail.append(s[n - rest:])
+        self._tail_len += rest
+        while self._tail_len - len(self._tail[0]) >= self.tail_limit:
+            self._tail_len -= len(self._tail.popleft())
+        return n
+
+    def getvalue(self) -> str:
+        head = "".join(self._head)
+        tail = "".join(self._tail)[-self.tail_limit:] if self.tail_limit > 0 else ""
+        omitted = self.total - len(head) - len(tail)
+        if omitted <= 0:
+            return head + tail
+        return f"{head}\n... [{omitted} chars omitted — {self.total} chars total] ...\n{tail}"
+
+
 def _exec_repl_block(code: str, namespace: dict) -> tuple[str, str]:
     """Execute a repl block in the shared namespace; return (stdout, stderr)."""
-    stdout_buf = io.StringIO()
-    stderr_buf = io.StringIO()
+    stdout_buf = CappedOutput(REPL_STDOUT_HEAD, REPL_STDOUT_TAIL)
+    stderr_buf = CappedOutput(REPL_STDERR_HEAD, REPL_STDERR_TAIL)
     try:
         with contextlib.redirect_stdout(stdout_buf), contextlib.redirect_stderr(stderr_buf):
             exec(code, namespace)
@@ -221,20 +406,41 @@ if not PROMPT:
 # ─── Build initial conversation ───────────────────────────────────────────────
 
 context_len = len(CONTEXT)
-try:
-    _ctx_parsed = json.loads(CONTEXT)
-    context_type = type(_ctx_parsed).__name__  # "list", "dict", etc.
-except (json.JSONDecodeError, ValueError):
-    context_type = "str"
+# In structured mode the REPL gets the lazy document view instead of the raw
+# string, so the model never has to json.loads() the context itself. Text mode
+# only needs the top-level type, which json.loads gets far faster than the scan.
+_structured = StructuredContext.parse(CONTEXT) if CONTEXT_MODE == "structured" else None
+if _structured is not None:
+    context_type = _structured.kind
+else:
+    try:
+        context_type = type(json.loads(CONTEXT)).__name__  # "list", "dict", etc.
+    except (json.JSONDecodeError, ValueError):
+        context_type = "str"
+
+REPL_CONTEXT = _structured if _structured is not None else CONTEXT
 
 metadata_prompt = f"Your context is a {context_type} with {context_len} total characters."
+if REPL_CONTEXT is not CONTEXT:
+    metadata_prompt = (
+        f"Your context is a {context_type} of {len(_structured)} documents with "
+        f"{context_len} total characters. It is already parsed: `context[i]` returns "
+        "document i (decoded on first access), `context.lengths` / `context.offsets` give "
+        "each document's size and position in characters, and `context.text(i)` returns "
+        "its raw JSON."
+        + (" Dict keys are available via `context.keys()` and `context[key]`."
+           if context_type == "dict" else "")
+    )
+
+preview_hint = ("`print(context)` and `print(context.lengths[:50])`" if REPL_CONTEXT is not CONTEXT
+                else "`print(context[:2000])`")
 
 initial_user_prompt = (
     f"You have been asked: {PROMPT}\n\n"
     "IMPORTANT RULES:\n"
     "1. The `context` variable already contains the document/data you need. Do NOT reassign or overwrite it.\n"
     "2. Use `llm_query(prompt)` or `llm_query_batched(prompts)` to analyze the content — never try to manually parse it with string splits.\n"
-    "3. Use `print(context[:2000])` to preview the context, then use llm_query() to analyze chunks.\n\n"
+    f"3. Use {preview_hint} to preview the context, then use llm_query() to analyze chunks.\n\n"
     "Think step-by-step on what to do using the REPL environment (which contains the context) "
     "to answer the prompt. You have not interacted with the REPL environment or seen your "
     "context yet. Your next action should be to look through and figure out how to answer the "
@@ -273,7 +479,7 @@ def _FINAL_VAR(var_name: str):
 
 
 repl_namespace: dict = {
-    "context": CONTEXT,
+    "context": REPL_CONTEXT,
     "llm_query": _sub_llm_call,
     "llm_query_batched": _sub_llm_batched,
     "SHOW_VARS": SHOW_VARS,
@@ -303,7 +509,7 @@ for iteration in range(MAX_ITERATIONS):
         _push_event({"type": "repl_exec", "iteration": iteration, "code": code})
         stdout, stderr = _exec_repl_block(code, repl_namespace)
         # Restore protected namespace variables in case the model overwrote them
-        repl_namespace["context"] = CONTEXT
+        repl_namespace["context"] = REPL_CONTEXT
         repl_namespace["llm_query"] = _sub_llm_call
         repl_namespace["llm_query_batched"] = _sub_llm_batched
         repl_namespace["SHOW_VARS"] = SHOW_VARS
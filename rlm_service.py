@@ -8,6 +8,8 @@ back to Next.js), this service:
   - Makes direct API calls to Cerebras / DeepSeek from Python
   - Streams NDJSON events (same format the frontend already consumes)
   - Runs persistently — no cold-start overhead, no circular HTTP dependency
+  - Admits at most RLM_MAX_SESSIONS sessions at once, queues up to RLM_MAX_QUEUE
+    more by priority, and answers 429 + Retry-After beyond that
 
 Start with:
   CEREBRAS_API_KEY=... DEEPSEEK_API_KEY=... python3 rlm_service.py
@@ -18,15 +20,27 @@ Start with:
 import os
 import re
 import io
+import sys
+import gzip
+import heapq
 import json
+import time
+import uuid
+import hashlib
+import importlib
+import pickle
+import types
+import argparse
+import functools
+import collections
+import itertools
 import threading
 import contextlib
 import concurrent.futures
-import queue as sync_queue
 import asyncio
 
 from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from openai import OpenAI
@@ -80,21 +94,196 @@ def _chat_completion(client: OpenAI, model: str, messages: list, timeout: int =
         return f"[LLM error: {e}]"
 
 
+# ─── Session traces ───────────────────────────────────────────────────────────
+#
+# A trace is gzip'd NDJSON: one header line ({"trace": 1, prompt, model, context,
+# options}), then one line per provider call ({"kind", "hash", "t", "ms",
+# "response"}) and per pushed event ({"t", "event"}), with t in seconds since
+# the session started.
+
+RLM_TRACE_DIR = os.environ.get("RLM_TRACE_DIR", "rlm_traces")
+
+
+def _messages_hash(model: str, messages: list) -> str:
+    payload = json.dumps([model, messages], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class TraceRecorder:
+    """Writes a session's provider calls and events to a trace file as they happen."""
+
+    def __init__(self, path: str, header: dict):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self._write({"trace": 1, **header})
+
+    def _write(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._t0
+
+    def call(self, kind: str, model: str, messages: list, response: str, started: float):
+        self._write({"kind": kind, "hash": _messages_hash(model, messages),
+                     "t": round(started, 4), "ms": round((self.elapsed() - started) * 1000, 1),
+                     "response": response})
+
+    def event(self, event: dict):
+        self._write({"t": round(self.elapsed(), 4), "event": event})
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ReplayClient:
+    """
+    Offline stand-in for the provider that serves answers from a recorded trace.
+
+    Calls are matched by a hash of (model, messages); when an engine change alters
+    a request, the next unused recorded call of the same kind ("root" / "sub") is
+    served instead. latency_scale=0 answers instantly, 1 replays recorded latency.
+    """
+
+    def __init__(self, path: str, latency_scale: float = 0.0):
+        self.latency_scale = latency_scale
+        self._by_hash = collections.defaultdict(collections.deque)
+        self._by_kind = collections.defaultdict(list)
+        self._used: set = set()
+        self._lock = threading.Lock()
+        self.misses = 0
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            self.header = json.loads(f.readline())
+            for i, line in enumerate(f):
+                rec = json.loads(line)
+                if "kind" not in rec:
+                    continue
+                rec["id"] = i
+                self._by_hash[rec["hash"]].append(rec)
+                self._by_kind[rec["kind"]].append(rec)
+
+    def _take(self, kind: str, model: str, messages: list):
+        with self._lock:
+            queue = self._by_hash.get(_messages_hash(model, messages))
+            while queue:
+                rec = queue.popleft()
+                if rec["id"] not in self._used:
+                    self._used.add(rec["id"])
+                    return rec
+            self.misses += 1
+            for rec in self._by_kind.get(kind, ()):
+                if rec["id"] not in self._used:
+                    self._used.add(rec["id"])
+                    return rec
+        return None
+
+    def complete(self, kind: str, model: str, messages: list) -> str:
+        rec = self._take(kind, model, messages)
+        if rec is None:
+            return f"[LLM error: replay trace has no more {kind} calls]"
+        if self.latency_scale > 0:
+            time.sleep(rec["ms"] / 1000 * self.latency_scale)
+        return rec["response"]
+
+
+# ─── Checkpoints ──────────────────────────────────────────────────────────────
+#
+# A checkpointed session pickles its state to RLM_CHECKPOINT_DIR/<session_id>.pkl
+# after every iteration: the conversation, each REPL variable that pickles on its
+# own (modules are stored by name and re-imported), and the responses of completed
+# sub-calls keyed by _messages_hash. Resuming restores all three, so the root LM
+# continues at the next iteration and a sub-call it re-issues is answered from the
+# checkpoint (each stored response at most once) instead of the provider.
+
+RLM_CHECKPOINT_DIR = os.environ.get("RLM_CHECKPOINT_DIR", "rlm_checkpoints")
+CHECKPOINT_VERSION = 2
+_SESSION_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def _checkpoint_path(session_id: str) -> str:
+    if not _SESSION_ID_RE.fullmatch(session_id):
+        raise ValueError(f"Invalid session id: {session_id!r}")
+    return os.path.join(RLM_CHECKPOINT_DIR, f"{session_id}.pkl")
+
+
+def _context_hash(context: str) -> str:
+    return hashlib.sha1(context.encode("utf-8")).hexdigest()
+
+
+def _pickle_namespace(namespace: dict) -> tuple[dict, list]:
+    """Pickle user variables one by one; returns (saved, names that couldn't be pickled)."""
+    saved, dropped = {}, []
+    for name, value in list(namespace.items()):
+        if name.startswith("_") or name in PROTECTED_KEYS:
+            continue
+        if isinstance(value, types.ModuleType):
+            saved[name] = ("module", value.__name__)
+            continue
+        try:
+            saved[name] = ("pickle", pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            dropped.append(name)  # futures, generators, open files, ...
+    return saved, dropped
+
+
+def _unpickle_namespace(saved: dict) -> tuple[dict, list]:
+    restored, dropped = {}, []
+    for name, (how, payload) in saved.items():
+        try:
+            restored[name] = (importlib.import_module(payload) if how == "module"
+                              else pickle.loads(payload))
+        except Exception:
+            dropped.append(name)
+    return restored, dropped
+
+
+def _save_checkpoint(session_id: str, state: dict):
+    path = _checkpoint_path(session_id)
+    os.makedirs(RLM_CHECKPOINT_DIR, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)  # a crash mid-write leaves the previous checkpoint intact
+
+
+def _load_checkpoint(session_id: str) -> dict:
+    path = _checkpoint_path(session_id)
+    if not os.path.exists(path):
+        raise ValueError(f"No checkpoint found for session {session_id}")
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _delete_checkpoint(session_id: str):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(_checkpoint_path(session_id))
+
+
 # ─── System prompt ─────────────────────────────────────────────────────────────
 
+# How the model should first look at its context; structured mode swaps in a
+# hint that doesn't decode thousands of documents just to print them.
+TEXT_INSPECT_HINT = "`print(len(context))` and `print(context[:3000])`"
+
 SYSTEM_PROMPT = """You are tasked with answering a query with associated context. You can access, transform, and analyze this context interactively in a REPL environment that can recursively query sub-LLMs, which you are strongly encouraged to use as much as possible. You will be queried iteratively until you provide a final answer.
 
 The REPL environment is initialized with:
 1. A `context` variable that contains extremely important information about your query. You should check the content of the `context` variable to understand what you are working with. Make sure you look through it sufficiently as you answer your query.
 2. A `llm_query` function that allows you to query an LLM inside your REPL environment.
 3. A `llm_query_batched` function that allows you to query multiple prompts concurrently: `llm_query_batched(prompts: List[str]) -> List[str]`. This is much faster than sequential `llm_query` calls when you have multiple independent queries. Results are returned in the same order as the input prompts.
-4. A `SHOW_VARS()` function that returns all variables you have created in the REPL. Use this to check what variables exist before using FINAL_VAR.
-5. The ability to use `print()` statements to view the output of your REPL code and continue your reasoning.
+4. A `llm_map_reduce` function for the common "ask every chunk, then combine" pattern: `llm_map_reduce(items: List[str], map_prompt: str, reduce_prompt: str) -> str`. It runs `map_prompt` over every item in parallel (the item is given to the sub-LLM as its context), then merges the answers with `reduce_prompt` in parallel rounds sized to the sub-LLM's limit until one answer remains. Prefer it over aggregating many answers in a single `llm_query`.
+5. A `llm_query_async` function that starts a query in the background and returns a future immediately: `fut = llm_query_async(prompt)`, then `fut.result()` when you need the answer. Keep working (regex, other queries) while it runs — futures survive across REPL blocks and iterations. `gather(futs)` returns all answers in order; `for f in as_completed(futs): ...` yields each future as it finishes. FINAL_VAR on a future returns its answer.
+6. A `SHOW_VARS()` function that returns all variables you have created in the REPL. Use this to check what variables exist before using FINAL_VAR.
+7. The ability to use `print()` statements to view the output of your REPL code and continue your reasoning.
 
 STRATEGY for large context (e.g. a PDF):
-- Phase 1 (first action): Inspect `context` structure — `print(len(context))` and `print(context[:3000])`.
+- Phase 1 (first action): Inspect `context` structure — {INSPECT_HINT}.
 - Phase 2: Use regex or string search to find natural chunk boundaries (section headers, paragraphs, etc.). Use `llm_query_batched` to analyze chunks in parallel.
-- Phase 3: Aggregate sub-LM results into a final answer and call FINAL().
+- Phase 3: Aggregate sub-LM results into a final answer and call FINAL(). With many chunks, `llm_map_reduce(chunks, question, "Combine these partial answers into one: ...")` does Phases 2–3 in one call.
 
 CRITICAL RULES:
 - Do NOT pass the full context string into a single llm_query() call — chunk it first. Each sub-LM call can handle ~100K chars.
@@ -141,17 +330,288 @@ WARNING — COMMON MISTAKE: FINAL_VAR retrieves an EXISTING variable. Create and
 Think step by step. Execute immediately — do not just describe what you will do."""
 
 
+# ─── Structured context ───────────────────────────────────────────────────────
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WS = re.compile(r"[ \t\n\r]*")
+
+
+class StructuredContext:
+    """
+    Lazily decoded view over a JSON list/dict context.
+
+    The raw text is scanned once for top-level document boundaries; each document
+    is only json-decoded the first time it is accessed and then cached, so a
+    large array is never materialised in full unless the model walks all of it.
+    Behaves like a list (or, for dicts, a list of values that can also be
+    indexed by key).
+    """
+
+    def __init__(self, raw: str, kind: str, spans: list, keys: list | None = None):
+        self._raw = raw
+        self.kind = kind
+        self._spans = spans
+        self._keys = keys
+        self._index = {k: i for i, k in enumerate(keys)} if keys is not None else None
+        self._cache: dict = {}
+        self.offsets = [s for s, _ in spans]
+        self.lengths = [e - s for s, e in spans]
+
+    @classmethod
+    def parse(cls, raw: str):
+        """
+        Scan `raw` as a JSON array/object; returns None if it isn't one.
+
+        Elements are walked one at a time with the C decoder's raw_decode, keeping
+        only their spans, so peak memory is one document rather than the whole tree.
+        The decoded values are discarded, so a document that is later accessed is
+        decoded a second time by _doc; the scan itself is still a single pass.
+        """
+        pos = _JSON_WS.match(raw).end()
+        if pos >= len(raw) or raw[pos] not in "[{":
+            return None
+        kind = "list" if raw[pos] == "[" else "dict"
+        close = "]" if kind == "list" else "}"
+        spans, keys = [], ([] if kind == "dict" else None)
+        pos = _JSON_WS.match(raw, pos + 1).end()
+        try:
+            if raw[pos] == close:
+                pos += 1
+            else:
+                while True:
+                    if kind == "dict":
+                        key, pos = _JSON_DECODER.raw_decode(raw, pos)
+                        if not isinstance(key, str):
+                            return None
+                        keys.append(key)
+                        pos = _JSON_WS.match(raw, pos).end()
+                        if raw[pos] != ":":
+                            return None
+                        pos = _JSON_WS.match(raw, pos + 1).end()
+                    _, end = _JSON_DECODER.raw_decode(raw, pos)
+                    spans.append((pos, end))
+                    pos = _JSON_WS.match(raw, end).end()
+                    if raw[pos] == close:
+                        pos += 1
+                        break
+                    if raw[pos] != ",":
+                        return None
+                    pos = _JSON_WS.match(raw, pos + 1).end()
+        except (IndexError, ValueError):
+            return None
+        if raw[pos:].strip():
+            return None
+        return cls(raw, kind, spans, keys)
+
+    @property
+    def raw(self) -> str:
+        """The whole context as the original JSON text."""
+        return self._raw
+
+    def text(self, i: int) -> str:
+        """Raw JSON text of document `i` (no decoding)."""
+        start, end = self._spans[i]
+        return self._raw[start:end]
+
+    def keys(self) -> list:
+        return list(self._keys) if self._keys is not None else list(range(len(self)))
+
+    def items(self):
+        return zip(self.keys(), self)
+
+    def _doc(self, i: int):
+        if i not in self._cache:
+            self._cache[i] = _JSON_DECODER.raw_decode(self._raw, self._spans[i][0])[0]
+        return self._cache[i]
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def __iter__(self):
+        return (self._doc(i) for i in range(len(self)))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._doc(i) for i in range(*key.indices(len(self)))]
+        if isinstance(key, str):
+            if self._index is None or key not in self._index:
+                raise KeyError(key)
+            return self._doc(self._index[key])
+        return self._doc(range(len(self))[key])
+
+    def __repr__(self) -> str:
+        return (f"<StructuredContext {self.kind}: {len(self)} documents, "
+                f"{len(self._raw)} chars>")
+
+
+def _ctx_text(ctx) -> str:
+    """Text to send as a sub-call's context: StructuredContext views and other
+    JSON-able values (e.g. `context[:2]` in structured mode) are serialised."""
+    if ctx is None:
+        return ""
+    if isinstance(ctx, str):
+        return ctx
+    if isinstance(ctx, StructuredContext):
+        return ctx.raw
+    return json.dumps(ctx, default=str, ensure_ascii=False)
+
+
 # ─── REPL helpers ─────────────────────────────────────────────────────────────
 
+# How much of a REPL block's output is kept: the first HEAD and last TAIL chars.
+# Defaults keep stdout + stderr together under the 10K per-block conversation cap.
+REPL_STDOUT_HEAD = int(os.environ.get("RLM_REPL_STDOUT_HEAD", "6000"))
+REPL_STDOUT_TAIL = int(os.environ.get("RLM_REPL_STDOUT_TAIL", "2000"))
+REPL_STDERR_HEAD = int(os.environ.get("RLM_REPL_STDERR_HEAD", "800"))
+REPL_STDERR_TAIL = int(os.environ.get("RLM_REPL_STDERR_TAIL", "800"))
+
+
+class CappedOutput(io.TextIOBase):
+    """
+    Write-only text stream that keeps just the first `head` and last `tail`
+    chars written plus a running total, so capture memory stays constant no
+    matter how much the REPL prints (e.g. `print(context)` on a huge document).
+    """
+
+    def __init__(self, head: int, tail: int):
+        self.head_limit = head
+        self.tail_limit = tail
+        self._head: list[str] = []
+        self._head_len = 0
+        self._tail: collections.deque = collections.deque()
+        self._tail_len = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        with self._lock:
+            return self._write(s)
+
+    def _write(self, s: str) -> int:
+        n = len(s)
+        self.total += n
+        room = self.head_limit - self._head_len
+        if room > 0:
+            self._head.append(s[:room])
+            self._head_len += min(n, room)
+        rest = n - max(room, 0)
+        if rest <= 0 or self.tail_limit <= 0:
+            return n
+        if rest >= self.tail_limit:
+            self._tail.clear()
+            self._tail.append(s[n - self.tail_limit:])
+            self._tail_len = self.tail_limit
+            return n
+        self._tail.append(s[n - rest:])
+        self._tail_len += rest
+        while self._tail_len - len(self._tail[0]) >= self.tail_limit:
+            self._tail_len -= len(self._tail.popleft())
+        return n
+
+    def getvalue(self) -> str:
+        with self._lock:
+            head = "".join(self._head)
+            tail = "".join(self._tail)[-self.tail_limit:] if self.tail_limit > 0 else ""
+        omitted = self.total - len(head) - len(tail)
+        if omitted <= 0:
+            return head + tail
+        return f"{head}\n... [{omitted} chars omitted — {self.total} chars total] ...\n{tail}"
+
+
+# Output capture is per thread rather than a swap of the process-global
+# sys.stdout (contextlib.redirect_stdout), so sessions executing REPL blocks
+# concurrently each get only their own prints. Threads started while a block is
+# capturing (threading.Thread, a ThreadPoolExecutor's workers) inherit its capture,
+# as they would with the global redirect. Once the block ends its buffers are
+# closed and such threads print to the server log again, so output from a pool
+# kept alive into later blocks is only captured for the block that started it.
+
+_capture = threading.local()
+_capture_install_lock = threading.Lock()
+_thread_start = threading.Thread.start
+
+
+def _start_with_capture(self):
+    """Thread.start that hands the starting thread's capture to the new thread."""
+    if getattr(_capture, "stdout", None) is not None or getattr(_capture, "stderr", None) is not None:
+        self.run = _bind_output(self.run)
+    return _thread_start(self)
+
+
+class _ThreadOutputRouter:
+    """
+    Stand-in for sys.stdout / sys.stderr that sends each write to the stream
+    the current thread is capturing into, or to the real stream otherwise.
+    """
+
+    def __init__(self, name: str, fallback):
+        self._name = name
+        self._fallback = fallback
+
+    def _target(self):
+        target = getattr(_capture, self._name, None)
+        return target if target is not None and not target.closed else self._fallback
+
+    def write(self, s: str) -> int:
+        return self._target().write(s)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._fallback, attr)
+
+
+def _install_output_router():
+    with _capture_install_lock:
+        if not isinstance(sys.stdout, _ThreadOutputRouter):
+            sys.stdout = _ThreadOutputRouter("stdout", sys.stdout)
+        if not isinstance(sys.stderr, _ThreadOutputRouter):
+            sys.stderr = _ThreadOutputRouter("stderr", sys.stderr)
+        threading.Thread.start = _start_with_capture
+
+
+@contextlib.contextmanager
+def _capture_output(stdout, stderr):
+    """Route this thread's prints into stdout / stderr for the duration."""
+    _install_output_router()
+    prev = (getattr(_capture, "stdout", None), getattr(_capture, "stderr", None))
+    _capture.stdout, _capture.stderr = stdout, stderr
+    try:
+        yield
+    finally:
+        _capture.stdout, _capture.stderr = prev
+
+
+def _bind_output(fn):
+    """Wrap fn so that, run on a worker thread, it prints into the caller's capture."""
+    stdout, stderr = getattr(_capture, "stdout", None), getattr(_capture, "stderr", None)
+    if stdout is None and stderr is None:
+        return fn
+
+    @functools.wraps(fn)
+    def bound(*args, **kwargs):
+        with _capture_output(stdout, stderr):
+            return fn(*args, **kwargs)
+    return bound
+
+
 def _exec_repl_block(code: str, namespace: dict) -> tuple[str, str]:
-    stdout_buf = io.StringIO()
-    stderr_buf = io.StringIO()
+    stdout_buf = CappedOutput(REPL_STDOUT_HEAD, REPL_STDOUT_TAIL)
+    stderr_buf = CappedOutput(REPL_STDERR_HEAD, REPL_STDERR_TAIL)
     try:
-        with contextlib.redirect_stdout(stdout_buf), contextlib.redirect_stderr(stderr_buf):
+        with _capture_output(stdout_buf, stderr_buf):
             exec(code, namespace)
     except Exception as e:
         stderr_buf.write(f"Error: {type(e).__name__}: {e}\n")
-    return stdout_buf.getvalue(), stderr_buf.getvalue()
+    stdout, stderr = stdout_buf.getvalue(), stderr_buf.getvalue()
+    # Threads the block started and left running print to the server log from now on
+    stdout_buf.close()
+    stderr_buf.close()
+    return stdout, stderr
 
 
 def _extract_repl_blocks(text: str) -> list[str]:
@@ -166,6 +626,8 @@ def _extract_final(text: str, namespace: dict):
     if m:
         var_name = m.group(1)
         val = namespace.get(var_name)
+        if isinstance(val, concurrent.futures.Future):
+            val = val.result()
         return str(val) if val is not None else f"[variable '{var_name}' not found]"
 
     m = re.search(r"FINAL\((.+?)\)", stripped, re.DOTALL)
@@ -183,54 +645,430 @@ def _extract_final(text: str, namespace: dict):
 # ─── Core RLM loop ────────────────────────────────────────────────────────────
 
 PROTECTED_KEYS = frozenset(
-    {"context", "llm_query", "llm_query_batched", "SHOW_VARS", "FINAL", "FINAL_VAR", "__builtins__"}
+    {"context", "llm_query", "llm_query_batched", "llm_map_reduce",
+     "llm_query_async", "as_completed", "gather",
+     "SHOW_VARS", "FINAL", "FINAL_VAR", "__builtins__"}
+)
+
+# Worker threads per session for llm_query_async
+ASYNC_QUERY_WORKERS = 16
+
+# Separator between partial answers packed into one reduce call
+_REDUCE_SEP = "\n\n---\n\n"
+_REDUCE_CUT = "\n[partial answer truncated to fit the merge]"
+
+# Preferred split points for oversize sub-call contexts, strongest first
+_SPLIT_BOUNDARIES = ("\n\n", "\n", ". ", " ")
+
+
+def _split_at_boundaries(text: str, limit: int) -> list[str]:
+    """
+    Split text into consecutive pieces of at most `limit` chars, cutting at the
+    strongest boundary found in the second half of each window (hard cut if none).
+    """
+    pieces, pos = [], 0
+    while len(text) - pos > limit:
+        window = text[pos:pos + limit]
+        cut = limit
+        for sep in _SPLIT_BOUNDARIES:
+            i = window.rfind(sep)
+            if i >= limit // 2:
+                cut = i + len(sep)
+                break
+        pieces.append(text[pos:pos + cut])
+        pos += cut
+    pieces.append(text[pos:])
+    return pieces
+
+
+# Prompt packing for llm_query_batched: prompts up to _PACK_MAX_ITEM_CHARS are
+# grouped (at most _PACK_MAX_ITEMS per request) into one multi-item request.
+_PACK_MAX_ITEM_CHARS = 2_000
+_PACK_MAX_ITEMS = 40
+_PACK_ITEM_OVERHEAD = 40  # <request id="..."> tags around each item
+
+_PACK_INSTRUCTIONS = (
+    "Answer each of the {n} independent requests below separately; they do not "
+    "share information. Respond with ONLY a JSON object that maps every request "
+    "id to its answer as a string, e.g. {{\"1\": \"...\", \"2\": \"...\"}}. "
+    "No text outside the JSON.\n\n"
 )
 
 
+def _pack_prompts(prompts: list[str]) -> str:
+    items = "".join(f'<request id="{i}">\n{p}\n</request>\n' for i, p in enumerate(prompts, 1))
+    return _PACK_INSTRUCTIONS.format(n=len(prompts)) + items
+
+
+def _unpack_answers(text: str, n: int) -> list:
+    """Per-item answers from a packed response, in order; None where missing/unparseable."""
+    start, end = text.find("{"), text.rfind("}")
+    try:
+        data = json.loads(text[start:end + 1]) if 0 <= start < end else None
+    except (json.JSONDecodeError, ValueError):
+        data = None
+    if not isinstance(data, dict):
+        return [None] * n
+    answers = []
+    for i in range(1, n + 1):
+        val = data.get(str(i))
+        if isinstance(val, (dict, list)):
+            val = json.dumps(val)
+        answers.append(str(val) if val is not None else None)
+    return answers
+
+
 def run_rlm_loop(
     prompt: str,
     model: str,
     context: str,
     push: callable,
     max_iterations: int = 10,
+    context_mode: str = "text",
+    overflow: str = "truncate",
+    pack_prompts: bool = False,
+    record_path: str | None = None,
+    replay: ReplayClient | None = None,
+    session_id: str | None = None,
+    resume: bool = False,
 ):
     """
     Runs the full RLM loop synchronously. Calls push(event_dict) for every event.
     Designed to be run in a background thread.
+
+    context_mode="structured" exposes a JSON list/dict context to the REPL as a
+    StructuredContext (scanned once, documents decoded lazily) instead of the raw
+    string. Non-JSON contexts fall back to "text".
+
+    overflow controls sub-calls whose ctx exceeds the model's CONTEXT_LIMITS:
+    "truncate" cuts it off, "fanout" splits it at boundaries, queries the pieces
+    concurrently as depth-2 child nodes and merges their answers into one.
+
+    pack_prompts=True makes llm_query_batched group small prompts into
+    multi-item requests (see _pack_prompts), falling back to individual calls
+    for any item whose answer can't be parsed.
+
+    record_path writes every provider request/response (with timing) and every
+    event to a trace file; replay serves provider calls from such a trace
+    instead of the network.
+
+    session_id checkpoints the session after every iteration (see Checkpoints);
+    resume=True continues that session from its last checkpoint. The prompt, model
+    and options are taken from the checkpoint and the context must be unchanged.
+    The checkpoint is removed once the session completes.
     """
-    client = _make_client(model)
-    call_counter = [0]
+    resume_state = None
+    if resume:
+        resume_state = _load_checkpoint(session_id)
+        if resume_state.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Checkpoint for session {session_id} is from an older version")
+        if resume_state["context_hash"] != _context_hash(context):
+            raise ValueError(f"Context does not match the checkpoint for session {session_id}")
+        prompt, model = resume_state["prompt"], resume_state["model"]
+        options = resume_state["options"]
+        context_mode, overflow, pack_prompts = (
+            options["context_mode"], options["overflow"], options["pack_prompts"])
+
+    client = _make_client(model) if replay is None else None
+    recorder = None
+    if record_path:
+        recorder = TraceRecorder(record_path, {
+            "prompt": prompt, "model": model, "context": context,
+            "options": {"max_iterations": max_iterations, "context_mode": context_mode,
+                        "overflow": overflow, "pack_prompts": pack_prompts},
+        })
+        _push = push
+
+        def push(event: dict):
+            recorder.event(event)
+            _push(event)
+
+    # Completed sub-call responses by _messages_hash. Those loaded from the
+    # checkpoint are each served once to an identical request after a resume;
+    # everything else goes to the provider and is recorded for the next checkpoint.
+    resumed_subcalls = ({k: collections.deque(v) for k, v in resume_state["subcalls"].items()}
+                        if resume_state else {})
+    subcalls = collections.defaultdict(list)
+    subcalls_lock = threading.Lock()
+
+    def _complete(messages: list, timeout: int, kind: str = "sub") -> str:
+        """Every provider call goes through here so it can be recorded / replayed."""
+        key = _messages_hash(model, messages) if session_id and kind == "sub" else None
+        if key:
+            with subcalls_lock:
+                if resumed_subcalls.get(key):
+                    response = resumed_subcalls[key].popleft()
+                    subcalls[key].append(response)
+                    return response
+        if replay is not None:
+            response = replay.complete(kind, model, messages)
+        else:
+            started = recorder.elapsed() if recorder else 0.0
+            response = _chat_completion(client, model, messages, timeout=timeout)
+            if recorder:
+                recorder.call(kind, model, messages, response, started)
+        if key and response and not response.startswith("[LLM error"):
+            with subcalls_lock:
+                subcalls[key].append(response)
+        return response
+
+    def _checkpoint(iteration: int, conversation: list, namespace: dict, next_node: int):
+        saved, dropped = _pickle_namespace(namespace)
+        with subcalls_lock:
+            done = {k: list(q) for k, q in resumed_subcalls.items() if q}
+            for k, responses in subcalls.items():
+                done.setdefault(k, []).extend(responses)
+        _save_checkpoint(session_id, {
+            "version": CHECKPOINT_VERSION, "prompt": prompt, "model": model,
+            "context_hash": _context_hash(context),
+            "options": {"context_mode": context_mode, "overflow": overflow,
+                        "pack_prompts": pack_prompts},
+            "iteration": iteration, "next_node": next_node, "conversation": conversation,
+            "namespace": saved, "unsaved": dropped,
+            "subcalls": done,
+        })
+        push({"type": "checkpoint", "sessionId": session_id, "iteration": iteration})
+
+    if resume_state:
+        push({"type": "resumed", "sessionId": session_id,
+              "iteration": resume_state["iteration"] + 1})
+
+    # Outlives individual REPL blocks so llm_query_async futures can span iterations
+    async_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=ASYNC_QUERY_WORKERS, thread_name_prefix="rlm-async")
+    try:
+        completed = _run_rlm_session(
+            prompt=prompt, model=model, context=context, push=push, complete=_complete,
+            async_pool=async_pool, max_iterations=max_iterations, context_mode=context_mode,
+            overflow=overflow, pack_prompts=pack_prompts,
+            checkpoint=_checkpoint if session_id else None, resume_state=resume_state,
+        )
+        if session_id and completed:
+            _delete_checkpoint(session_id)
+    finally:
+        async_pool.shutdown(wait=False, cancel_futures=True)
+        if recorder:
+            recorder.close()
+
+
+def _run_rlm_session(
+    prompt: str,
+    model: str,
+    context: str,
+    push: callable,
+    complete: callable,
+    async_pool: concurrent.futures.ThreadPoolExecutor,
+    max_iterations: int,
+    context_mode: str,
+    overflow: str,
+    pack_prompts: bool,
+    checkpoint: callable = None,
+    resume_state: dict | None = None,
+) -> bool:
+    """
+    Body of run_rlm_loop; all provider calls go through complete(messages, timeout, kind).
+
+    checkpoint(iteration, conversation, namespace, next_node) is called after
+    every iteration and when the root LM fails; resume_state is a loaded checkpoint
+    to continue from. Returns False if the session stopped on a root LM error.
+    """
+    last_node_id = [resume_state["next_node"] - 1 if resume_state else 0]
+    node_id_lock = threading.Lock()
     repl_final = [None]
     ctx_limit = CONTEXT_LIMITS.get(model, 30_000)
 
+    def _new_node_id() -> str:
+        with node_id_lock:
+            last_node_id[0] += 1
+            return f"node_{last_node_id[0]}"
+
     # ── Sub-LM calls ──────────────────────────────────────────────────────────
 
+    def _sub_llm_node(sub_prompt: str, ctx=None, parent_id: str = "root", depth: int = 1) -> str:
+        node_id = _new_node_id()
+
+        push({"type": "node_start", "nodeId": node_id, "parentId": parent_id,
+              "depth": depth, "prompt": sub_prompt})
+
+        effective_ctx = _ctx_text(ctx)
+        if overflow == "fanout" and len(effective_ctx) > ctx_limit:
+            response = _fan_out(sub_prompt, effective_ctx, node_id, depth + 1)
+        else:
+            msgs = []
+            if effective_ctx:
+                truncated = (
+                    effective_ctx[:ctx_limit]
+                    + ("\n[context truncated]" if len(effective_ctx) > ctx_limit else "")
+                )
+                msgs.append({"role": "system",
+                             "content": f"You are a helpful assistant.\n\nContext:\n{truncated}"})
+            msgs.append({"role": "user", "content": sub_prompt})
+            response = complete(msgs, timeout=120)
+
+        push({"type": "node_complete", "nodeId": node_id, "response": response})
+        return response
+
     def _sub_llm_call(sub_prompt: str, ctx=None) -> str:
-        call_counter[0] += 1
-        node_id = f"node_{call_counter[0]}"
+        return _sub_llm_node(sub_prompt, ctx)
+
+    def _fan_out(sub_prompt: str, ctx: str, parent_id: str, depth: int) -> str:
+        """Answer sub_prompt over an oversize ctx: query each piece, then merge."""
+        pieces = _split_at_boundaries(ctx, ctx_limit)
+        answers = _sub_llm_parallel([(sub_prompt, p) for p in pieces], parent_id, depth)
+        merge_prompt = (
+            f"The question below was asked separately about consecutive sections of one "
+            f"long document; the context holds the per-section answers in order. Combine "
+            f"them into a single complete answer to the question, ignoring sections that "
+            f"found nothing relevant.\n\nQuestion: {sub_prompt}"
+        )
+        return _tree_reduce(answers, merge_prompt, parent_id=parent_id, depth=depth)
+
+    def _sub_llm_parallel(calls: list, parent_id: str = "root", depth: int = 1) -> list:
+        """Run (prompt, ctx) sub-calls concurrently; results in input order."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            node = _bind_output(_sub_llm_node)
+            futures = [executor.submit(node, p, c, parent_id, depth) for p, c in calls]
+            return [f.result() for f in futures]
 
-        push({"type": "node_start", "nodeId": node_id, "parentId": "root",
-              "depth": 1, "prompt": sub_prompt})
+    def _sub_llm_packed(items: list, ctx=None) -> list:
+        """One request answering several small prompts; unparsed items are retried alone."""
+        node_id = _new_node_id()
+        push({"type": "node_start", "nodeId": node_id, "parentId": "root", "depth": 1,
+              "prompt": f"[{len(items)} packed prompts]\n" + "\n".join(p[:200] for p in items)})
 
         msgs = []
-        effective_ctx = ctx if ctx is not None else ""
-        if effective_ctx:
-            truncated = (
-                effective_ctx[:ctx_limit]
-                + ("\n[context truncated]" if len(effective_ctx) > ctx_limit else "")
-            )
+        if ctx:
             msgs.append({"role": "system",
-                         "content": f"You are a helpful assistant.\n\nContext:\n{truncated}"})
-        msgs.append({"role": "user", "content": sub_prompt})
-
-        response = _chat_completion(client, model, msgs, timeout=120)
+                         "content": f"You are a helpful assistant.\n\nContext:\n{ctx}"})
+        msgs.append({"role": "user", "content": _pack_prompts(items)})
+        response = complete(msgs, timeout=120)
         push({"type": "node_complete", "nodeId": node_id, "response": response})
-        return response
 
-    def _sub_llm_batched(prompts: list, ctx=None) -> list:
+        answers = _unpack_answers(response, len(items))
+        missing = [i for i, a in enumerate(answers) if a is None]
+        if missing:
+            retried = _sub_llm_parallel([(items[i], ctx) for i in missing])
+            for i, a in zip(missing, retried):
+                answers[i] = a
+        return answers
+
+    def _sub_llm_batched(prompts: list, ctx=None, pack=None) -> list:
+        prompts = list(prompts)
+        ctx = _ctx_text(ctx)
+        if not (pack_prompts if pack is None else pack):
+            return _sub_llm_parallel([(p, ctx) for p in prompts])
+
+        # Group consecutive small prompts into packs that fit next to ctx.
+        budget = ctx_limit - len(ctx or "") - len(_PACK_INSTRUCTIONS)
+        groups, cur, size = [], [], 0
+        for i, p in enumerate(prompts):
+            add = len(p) + _PACK_ITEM_OVERHEAD
+            if len(p) > _PACK_MAX_ITEM_CHARS or add > budget:
+                groups.append([i])
+                continue
+            if cur and (size + add > budget or len(cur) >= _PACK_MAX_ITEMS):
+                groups.append(cur)
+                cur, size = [], 0
+            cur.append(i)
+            size += add
+        if cur:
+            groups.append(cur)
+
+        def _run_group(g: list) -> list:
+            if len(g) == 1:
+                return [_sub_llm_call(prompts[g[0]], ctx)]
+            return _sub_llm_packed([prompts[i] for i in g], ctx)
+
+        results = [None] * len(prompts)
         with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(_sub_llm_call, p, ctx) for p in prompts]
-            return [f.result() for f in futures]
+            run_group = _bind_output(_run_group)
+            futures = [(g, executor.submit(run_group, g)) for g in groups]
+            for g, f in futures:
+                for i, a in zip(g, f.result()):
+                    results[i] = a
+        return results
+
+    def _reduce_groups(parts: list, reduce_prompt: str) -> list:
+        """
+        Pack consecutive parts into groups whose joined text fits the sub-call
+        context limit. Every group holds at least two parts (so each level shrinks),
+        except a trailing singleton which is carried up unchanged. When even a pair
+        is over the limit, each of its parts is cut to an equal share of it.
+        """
+        budget = ctx_limit - len(reduce_prompt)
+        groups, cur, size = [], [], 0
+        for part in parts:
+            add = len(part) + len(_REDUCE_SEP)
+            if len(cur) >= 2 and size + add > budget:
+                groups.append(cur)
+                cur, size = [], 0
+            cur.append(part)
+            size += add
+        if cur:
+            groups.append(cur)
+        for i, g in enumerate(groups):
+            if len(g) > 1 and len(_REDUCE_SEP.join(g)) > budget:
+                share = max(0, budget // len(g) - len(_REDUCE_SEP) - len(_REDUCE_CUT))
+                groups[i] = [p if len(p) <= share else p[:share] + _REDUCE_CUT for p in g]
+        return groups
+
+    def _tree_reduce(parts: list, reduce_prompt: str, on_level=None,
+                     parent_id: str = "root", depth: int = 1) -> str:
+        """
+        Merge `parts` into one answer with a multi-level tree reduction. Each
+        level's merges run in parallel; on_level(level, n_in, outputs, seconds)
+        is called after every level.
+        """
+        level = 0
+        while len(parts) > 1:
+            level += 1
+            t0 = time.monotonic()
+            groups = _reduce_groups(parts, reduce_prompt)
+            calls = [(reduce_prompt, _REDUCE_SEP.join(g)) for g in groups if len(g) > 1]
+            merged = iter(_sub_llm_parallel(calls, parent_id, depth))
+            n_in = len(parts)
+            parts = [next(merged) if len(g) > 1 else g[0] for g in groups]
+            if on_level:
+                on_level(level, n_in, parts, time.monotonic() - t0)
+        return parts[0] if parts else ""
+
+    def _llm_map_reduce(items, map_prompt: str, reduce_prompt: str) -> str:
+        """
+        Run map_prompt over every item in parallel (each item is the sub-call's
+        context), then tree-reduce the answers with reduce_prompt.
+        """
+        items = [_ctx_text(it) for it in items]
+        started = time.monotonic()
+        levels = []
+        push({"type": "map_reduce_start", "items": len(items)})
+
+        def _level_done(level, n_in, outputs, seconds):
+            levels.append({"level": level, "inputs": n_in, "outputs": len(outputs),
+                           "elapsedMs": round(seconds * 1000)})
+            push({"type": "map_reduce_level", **levels[-1],
+                  "partials": [o[:200] for o in outputs[:50]]})
+
+        t0 = time.monotonic()
+        mapped = _sub_llm_parallel([(map_prompt, it) for it in items])
+        _level_done(0, len(items), mapped, time.monotonic() - t0)
+
+        result = _tree_reduce(mapped, reduce_prompt, on_level=_level_done)
+        push({"type": "map_reduce_complete", "levels": levels,
+              "elapsedMs": round((time.monotonic() - started) * 1000)})
+        return result
+
+    def _llm_query_async(sub_prompt: str, ctx=None) -> concurrent.futures.Future:
+        """Start llm_query in the background; the future's result() is its answer."""
+        return async_pool.submit(_bind_output(_sub_llm_node), sub_prompt, ctx)
+
+    def _as_completed(futures, timeout=None):
+        return concurrent.futures.as_completed(list(futures), timeout=timeout)
+
+    def _gather(*futures, timeout=None) -> list:
+        """Results of the given futures (or one list of them), in order."""
+        if len(futures) == 1 and not isinstance(futures[0], concurrent.futures.Future):
+            futures = futures[0]
+        return [f.result(timeout=timeout) for f in futures]
 
     # ── REPL special functions ─────────────────────────────────────────────────
 
@@ -240,6 +1078,8 @@ def run_rlm_loop(
 
     def _FINAL_VAR(var_name: str):
         val = repl_namespace.get(var_name)
+        if isinstance(val, concurrent.futures.Future):
+            val = val.result()
         if val is not None:
             repl_final[0] = str(val)
             return val
@@ -249,62 +1089,104 @@ def run_rlm_loop(
         return {k: type(v).__name__ for k, v in repl_namespace.items()
                 if not k.startswith("_") and k not in PROTECTED_KEYS}
 
-    repl_namespace: dict = {
-        "context": context,
+    # Structured mode scans the JSON once into the REPL's `context`. Text mode only
+    # needs the top-level type, which the C json.loads gets far faster than the scan.
+    structured = StructuredContext.parse(context) if context_mode == "structured" else None
+    if structured is not None:
+        context_type = structured.kind
+    else:
+        try:
+            context_type = type(json.loads(context)).__name__
+        except ValueError:
+            context_type = "str"
+    repl_context = structured if structured is not None else context
+
+    repl_builtins = {
+        "context": repl_context,
         "llm_query": _sub_llm_call,
         "llm_query_batched": _sub_llm_batched,
+        "llm_map_reduce": _llm_map_reduce,
+        "llm_query_async": _llm_query_async,
+        "as_completed": _as_completed,
+        "gather": _gather,
         "SHOW_VARS": _SHOW_VARS,
         "FINAL": _FINAL,
         "FINAL_VAR": _FINAL_VAR,
-        "__builtins__": __builtins__,
     }
+    repl_namespace: dict = {**repl_builtins, "__builtins__": __builtins__}
 
     def _restore_protected():
         """Restore namespace vars the model may have accidentally overwritten."""
-        repl_namespace["context"] = context
-        repl_namespace["llm_query"] = _sub_llm_call
-        repl_namespace["llm_query_batched"] = _sub_llm_batched
-        repl_namespace["SHOW_VARS"] = _SHOW_VARS
-        repl_namespace["FINAL"] = _FINAL
-        repl_namespace["FINAL_VAR"] = _FINAL_VAR
+        repl_namespace.update(repl_builtins)
 
     # ── Build initial conversation ─────────────────────────────────────────────
 
-    try:
-        context_type = type(json.loads(context)).__name__
-    except (json.JSONDecodeError, ValueError):
-        context_type = "str"
-
     metadata_msg = f"Your context is a {context_type} with {len(context)} total characters."
+    inspect_hint = TEXT_INSPECT_HINT
+    if repl_context is structured:
+        metadata_msg = (
+            f"Your context is a {context_type} of {len(structured)} documents with "
+            f"{len(context)} total characters. It is already parsed: `context[i]` returns "
+            "document i (decoded on first access), `context.lengths` / `context.offsets` give "
+            "each document's size and position in characters, and `context.text(i)` returns "
+            "its raw JSON."
+            + (" Dict keys are available via `context.keys()` and `context[key]`."
+               if context_type == "dict" else "")
+        )
+        inspect_hint = "`print(context)` and `print(context.lengths[:50])`"
 
     initial_user_prompt = (
         f"You have been asked: {prompt}\n\n"
         "IMPORTANT RULES:\n"
         "1. The `context` variable already contains the document/data. Do NOT reassign it.\n"
         "2. Chunk the context before passing to llm_query() — never pass the full context in one call.\n"
-        "3. Start by inspecting: `print(len(context))` and `print(context[:3000])`\n\n"
+        f"3. Start by inspecting: {inspect_hint}\n\n"
         "You have not interacted with the REPL environment yet. "
         "Your first action should be to inspect the context and plan your approach. "
         "Do not provide a final answer yet.\n\nYour next action:"
     )
 
     conversation = [
-        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "system", "content": SYSTEM_PROMPT.replace("{INSPECT_HINT}", inspect_hint)},
         {"role": "assistant", "content": metadata_msg},
         {"role": "user", "content": initial_user_prompt},
     ]
 
+    # ── Resume from checkpoint ─────────────────────────────────────────────────
+
+    first_iteration = 0
+    if resume_state:
+        restored, lost = _unpickle_namespace(resume_state["namespace"])
+        repl_namespace.update(restored)
+        _restore_protected()
+        unsaved = sorted(set(resume_state["unsaved"]) | set(lost))
+        conversation = resume_state["conversation"]
+        first_iteration = resume_state["iteration"] + 1
+        if unsaved:
+            conversation[-1]["content"] = (
+                "[The session was resumed from a checkpoint. These REPL variables could "
+                f"not be restored and must be recreated if you need them: {', '.join(unsaved)}]\n\n"
+                + conversation[-1]["content"]
+            )
+
+    def _save(iteration: int):
+        if checkpoint is not None:
+            checkpoint(iteration, conversation, repl_namespace, last_node_id[0] + 1)
+
     # ── Main loop ──────────────────────────────────────────────────────────────
 
     final_answer = None
+    completed = True
     MAX_REPL_OUTPUT = 10_000
 
-    for iteration in range(max_iterations):
+    for iteration in range(first_iteration, max_iterations):
         push({"type": "iteration_start", "iteration": iteration})
 
-        response = _chat_completion(client, model, conversation, timeout=180)
+        response = complete(conversation, timeout=180, kind="root")
         if not response or response.startswith("[LLM error"):
             push({"type": "error", "error": response or "Empty response from root LLM"})
+            completed = False
+            _save(iteration - 1)  # keeps sub-calls finished by async queries since the last one
             break
 
         push({"type": "llm_response", "iteration": iteration, "text": response})
@@ -362,6 +1244,7 @@ def run_rlm_loop(
             "Your next action:"
         )
         conversation.append({"role": "user", "content": next_user})
+        _save(iteration)
 
     # ── Synthesis ──────────────────────────────────────────────────────────────
     # One final sub-LM call to convert raw REPL output into a clean human-readable answer.
@@ -394,6 +1277,127 @@ def run_rlm_loop(
 
     result = final_answer or "No answer could be determined."
     push({"type": "session_end", "nodeId": "root", "parentId": None, "response": result})
+    return completed
+
+
+# ─── Admission control ────────────────────────────────────────────────────────
+#
+# At most RLM_MAX_SESSIONS sessions run at once. Up to RLM_MAX_QUEUE more wait in
+# a priority heap (high, then normal, then low; FIFO within a tier) and are sent
+# their queue position and an ETA while they wait. Requests beyond that are
+# rejected immediately with 429 + Retry-After instead of slowing down the
+# sessions already running.
+
+RLM_MAX_SESSIONS = int(os.environ.get("RLM_MAX_SESSIONS", "4"))
+RLM_MAX_QUEUE = int(os.environ.get("RLM_MAX_QUEUE", "32"))
+PRIORITY_TIERS = {"high": 0, "normal": 1, "low": 2}
+
+
+class AdmissionTicket:
+    """One request's place in the admission queue."""
+
+    def __init__(self, priority: int, seq: int):
+        self.key = (priority, seq)
+        self.admitted = False
+        self.cancelled = False
+        self.queued_at = time.monotonic()
+        self.started_at = None
+
+    def __lt__(self, other: "AdmissionTicket") -> bool:
+        return self.key < other.key
+
+
+class AdmissionController:
+    """Bounded priority queue in front of the session threads."""
+
+    def __init__(self, max_sessions: int, max_queue: int):
+        self.max_sessions = max(1, max_sessions)
+        self.max_queue = max(0, max_queue)
+        self._heap: list = []
+        self._active = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._durations = collections.deque(maxlen=50)  # seconds, recent sessions
+        self.rejected = 0
+
+    def _avg_duration(self) -> float:
+        return sum(self._durations) / len(self._durations) if self._durations else 30.0
+
+    def _eta(self, position: int) -> float:
+        """Rough seconds until the position-th waiter (1-based) gets a slot."""
+        return position / self.max_sessions * self._avg_duration()
+
+    def _admit(self, ticket: AdmissionTicket):
+        ticket.admitted = True
+        ticket.started_at = time.monotonic()
+        self._active += 1
+
+    def enqueue(self, priority: int) -> AdmissionTicket | None:
+        """Admit or queue a new session. Returns None when the queue is full."""
+        with self._cond:
+            ticket = AdmissionTicket(priority, next(self._seq))
+            if self._active < self.max_sessions and not self._heap:
+                self._admit(ticket)
+            elif len(self._heap) >= self.max_queue:
+                self.rejected += 1
+                return None
+            else:
+                heapq.heappush(self._heap, ticket)
+                self._cond.notify_all()  # lower tiers move back a place
+            return ticket
+
+    def retry_after(self) -> int:
+        """Seconds a rejected client should wait before trying again."""
+        with self._cond:
+            return max(1, round(self._eta(len(self._heap) + 1)))
+
+    def wait(self, ticket: AdmissionTicket, on_position: callable) -> bool:
+        """
+        Block until ticket is admitted (True) or cancelled (False), calling
+        on_position(position, eta_seconds) whenever its place in the queue changes.
+        """
+        with self._cond:
+            last = None
+            while not ticket.admitted and not ticket.cancelled:
+                position = 1 + sum(t < ticket for t in self._heap)
+                if position != last:
+                    on_position(position, self._eta(position))
+                    last = position
+                self._cond.wait()
+            return ticket.admitted
+
+    def cancel(self, ticket: AdmissionTicket):
+        """Drop a ticket whose client disconnected before it was admitted."""
+        with self._cond:
+            if ticket.admitted or ticket.cancelled:
+                return
+            ticket.cancelled = True
+            self._heap.remove(ticket)
+            heapq.heapify(self._heap)
+            self._cond.notify_all()
+
+    def release(self, ticket: AdmissionTicket):
+        """Free an admitted ticket's slot and hand it to the next waiter."""
+        with self._cond:
+            self._durations.append(time.monotonic() - ticket.started_at)
+            self._active -= 1
+            if self._heap:
+                self._admit(heapq.heappop(self._heap))
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "active": self._active,
+                "queued": len(self._heap),
+                "max_sessions": self.max_sessions,
+                "max_queue": self.max_queue,
+                "rejected": self.rejected,
+                "avg_session_s": round(self._avg_duration(), 1),
+            }
+
+
+ADMISSION = AdmissionController(RLM_MAX_SESSIONS, RLM_MAX_QUEUE)
 
 
 # ─── FastAPI endpoint ──────────────────────────────────────────────────────────
@@ -403,47 +1407,189 @@ class RLMRequest(BaseModel):
     model: str = "llama3.1-8b"
     context: str = ""
     max_iterations: int = 10
+    context_mode: str = "text"  # "text" | "structured"
+    overflow: str = "truncate"  # "truncate" | "fanout"
+    pack_prompts: bool = False
+    record: bool = False  # write a replayable trace to RLM_TRACE_DIR
+    checkpoint: bool = False  # checkpoint every iteration to RLM_CHECKPOINT_DIR
+    resume: str | None = None  # session id to continue from its last checkpoint
+    priority: str = "normal"  # "high" | "normal" | "low"
 
 
 @app.post("/rlm-query")
 async def rlm_query(body: RLMRequest):
-    event_queue: sync_queue.Queue = sync_queue.Queue()
+    ticket = ADMISSION.enqueue(PRIORITY_TIERS.get(body.priority, PRIORITY_TIERS["normal"]))
+    if ticket is None:
+        return JSONResponse(
+            {"error": "RLM service is at capacity, retry later"},
+            status_code=429,
+            headers={"Retry-After": str(ADMISSION.retry_after())},
+        )
+
+    # Session threads hand events to the loop directly, so waiting clients don't
+    # each pin an executor thread
+    loop = asyncio.get_running_loop()
+    event_queue: asyncio.Queue = asyncio.Queue()
+
+    def push(event: dict | None):
+        loop.call_soon_threadsafe(event_queue.put_nowait, event)
+
+    record_path = None
+    if body.record:
+        trace_id = uuid.uuid4().hex
+        record_path = os.path.join(RLM_TRACE_DIR, f"{trace_id}.ndjson.gz")
+        push({"type": "trace", "traceId": trace_id})
+
+    session_id = body.resume
+    if session_id is None and body.checkpoint:
+        session_id = uuid.uuid4().hex
+        push({"type": "session", "sessionId": session_id})
+
+    def on_position(position: int, eta: float):
+        push({"type": "queued", "position": position, "etaMs": round(eta * 1000)})
 
     def run():
         try:
+            if not ticket.admitted:
+                if not ADMISSION.wait(ticket, on_position):
+                    return  # client went away while queued
+                push({"type": "admitted",
+                      "waitedMs": round((ticket.started_at - ticket.queued_at) * 1000)})
             run_rlm_loop(
                 prompt=body.prompt,
                 model=body.model,
                 context=body.context,
-                push=lambda e: event_queue.put(e),
+                push=push,
                 max_iterations=body.max_iterations,
+                context_mode=body.context_mode,
+                overflow=body.overflow,
+                pack_prompts=body.pack_prompts,
+                record_path=record_path,
+                session_id=session_id,
+                resume=body.resume is not None,
             )
         except Exception as e:
-            event_queue.put({"type": "error", "error": str(e)})
+            push({"type": "error", "error": str(e)})
         finally:
-            event_queue.put(None)  # sentinel to end the stream
+            if ticket.admitted:
+                ADMISSION.release(ticket)
+            push(None)  # sentinel to end the stream
 
     thread = threading.Thread(target=run, daemon=True)
     thread.start()
 
     async def generate():
-        loop = asyncio.get_event_loop()
-        while True:
-            # Block in executor so we don't stall the event loop
-            event = await loop.run_in_executor(None, event_queue.get)
-            if event is None:
-                break
-            yield json.dumps(event) + "\n"
+        try:
+            while True:
+                event = await event_queue.get()
+                if event is None:
+                    break
+                yield json.dumps(event) + "\n"
+        finally:
+            ADMISSION.cancel(ticket)  # no-op once admitted
 
     return StreamingResponse(generate(), media_type="text/event-stream")
 
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {"status": "ok", "sessions": ADMISSION.stats()}
+
+
+# ─── Offline replay ────────────────────────────────────────────────────────────
+
+def _replay_main(argv: list):
+    """python3 rlm_service.py replay TRACE [--latency-scale X] — re-run a trace offline."""
+    parser = argparse.ArgumentParser(prog="rlm_service.py replay",
+                                     description="Replay a recorded RLM session and report timings.")
+    parser.add_argument("trace")
+    parser.add_argument("--latency-scale", type=float, default=0.0,
+                        help="0 = instant answers, 1 = recorded provider latency")
+    args = parser.parse_args(argv)
+
+    replay = ReplayClient(args.trace, args.latency_scale)
+    header = replay.header
+    counts = collections.Counter()
+    marks = []
+    t0 = time.monotonic()
+
+    def push(event: dict):
+        counts[event["type"]] += 1
+        if event["type"] in ("iteration_start", "synthesis_start", "session_end"):
+            marks.append((event["type"], event.get("iteration"), time.monotonic() - t0))
+
+    run_rlm_loop(prompt=header["prompt"], model=header["model"], context=header["context"],
+                 push=push, replay=replay, **header["options"])
+
+    total = time.monotonic() - t0
+    prev = 0.0
+    for kind, iteration, t in marks:
+        label = f"{kind} {iteration}" if iteration is not None else kind
+        print(f"{label:<22} at {t * 1000:9.1f} ms  (+{(t - prev) * 1000:.1f} ms)")
+        prev = t
+    print(f"total {total * 1000:.1f} ms, replay misses: {replay.misses}")
+    print("events: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+
+
+# ─── Output isolation check ────────────────────────────────────────────────────
+
+def check_isolation(sessions: int = 16, blocks: int = 20, lines: int = 50, workers: int = 8):
+    """
+    Stress test for per-thread output capture: `sessions` threads each run
+    `blocks` REPL blocks at once, printing tagged lines from the block itself,
+    to stderr, from pool workers (bound like llm_query_batched's) and from a
+    thread and a ThreadPoolExecutor the block starts itself. Every block must
+    get back exactly its own lines.
+    """
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    code = (
+        f"for i in range({lines}):\n"
+        "    print(TAG, i)\n"
+        "print(TAG, 'err', file=sys.stderr)\n"
+        f"list(pool_map(lambda i: print(TAG, 'worker', i), range({workers})))\n"
+        "t = threading.Thread(target=print, args=(TAG, 'thread'))\n"
+        "t.start(); t.join()\n"
+        "with concurrent.futures.ThreadPoolExecutor(2) as own:\n"
+        "    list(own.map(lambda i: print(TAG, 'own', i), range(2)))\n"
+    )
+    failures = []
+    start = threading.Barrier(sessions)
+
+    def session(n: int):
+        start.wait()
+        for b in range(blocks):
+            tag = f"s{n}b{b}"
+            namespace = {"TAG": tag, "sys": sys, "threading": threading,
+                         "concurrent": concurrent, "__builtins__": __builtins__,
+                         "pool_map": lambda fn, it: pool.map(_bind_output(fn), it)}
+            stdout, stderr = _exec_repl_block(code, namespace)
+            out, err = stdout.splitlines(), stderr.splitlines()
+            if (len(out) != lines + workers + 3 or err != [f"{tag} err"]
+                    or any(line.split()[0] != tag for line in out)):
+                failures.append((tag, stdout, stderr))
+
+    threads = [threading.Thread(target=session, args=(n,)) for n in range(sessions)]
+    t0 = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    pool.shutdown()
+    print(f"{sessions} sessions x {blocks} blocks in {time.monotonic() - t0:.2f}s, "
+          f"{len(failures)} with foreign or missing output")
+    if failures:
+        tag, stdout, stderr = failures[0]
+        raise SystemExit(f"output leaked between sessions, e.g. {tag}:\n{stdout}{stderr}")
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        _replay_main(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "check-isolation":
+        check_isolation()
+        sys.exit(0)
+
     import uvicorn
     port = int(os.environ.get("RLM_PORT", "8000"))
     uvicorn.run(app, host="0.0.0.0", port=port)
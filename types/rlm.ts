@@ -30,13 +30,30 @@ export type RLMRun = {
   createdAt: Date;
 };
 
+/** Timing for one level of llm_map_reduce (level 0 is the map phase) */
+export type RLMMapReduceLevel = {
+  level: number;
+  inputs: number;
+  outputs: number;
+  elapsedMs: number;
+};
+
 export type RLMEvent =
   | { type: "status"; message: string }
+  | { type: "trace"; traceId: string }
+  | { type: "session"; sessionId: string }
+  | { type: "checkpoint"; sessionId: string; iteration: number }
+  | { type: "resumed"; sessionId: string; iteration: number }
+  | { type: "queued"; position: number; etaMs: number }
+  | { type: "admitted"; waitedMs: number }
   | { type: "iteration_start"; iteration: number }
   | { type: "llm_response"; iteration: number; text: string }
   | { type: "repl_exec"; iteration: number; code: string }
   | { type: "repl_output"; iteration: number; code: string; output: string }
   | { type: "node_start"; nodeId: string; parentId: string; depth: number; prompt: string }
   | { type: "node_complete"; nodeId: string; response: string }
+  | { type: "map_reduce_start"; items: number }
+  | ({ type: "map_reduce_level" } & RLMMapReduceLevel & { partials: string[] })
+  | { type: "map_reduce_complete"; levels: RLMMapReduceLevel[]; elapsedMs: number }
   | { type: "session_end"; nodeId: string; parentId: null; response: string }
   | { type: "error"; error: string };